@@ -1,10 +1,17 @@
+from enum import IntEnum
+import math
 import os
 from pathlib import Path
-import firebase_admin
-from firebase_admin import credentials, db
-import random
+import numpy as np
+import queue
+import threading
 import time
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; a vectorized NumPy step is used instead
+    njit = None
+
 """Send fake readings to Firebase Realtime Database.
 
 Configuration: credentials are loaded from the FIREBASE_CREDENTIALS
@@ -21,128 +28,298 @@ DEFAULT_CRED_FILE = "spider-doctor-firebase-adminsdk-fbsvc-aec2e00c74.json"
 CRED_FILE = os.environ.get("FIREBASE_CREDENTIALS", DEFAULT_CRED_FILE)
 CRED_PATH = (Path(CRED_FILE) if os.path.isabs(CRED_FILE) else BASE_DIR / CRED_FILE)
 
-if not CRED_PATH.exists():
-        raise FileNotFoundError(
-                f"Firebase credentials file not found: {CRED_PATH}\n"
-                "Tip: Put your service account JSON next to this script or set FIREBASE_CREDENTIALS to its absolute path."
-        )
-
-# Load service account credentials
-cred = credentials.Certificate(str(CRED_PATH))
-
-# Initialize Firebase app
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': 'https://spider-doctor-default-rtdb.firebaseio.com/'
-    })
+# HTTP timeout (seconds) for database calls; can be overridden by HTTP_TIMEOUT.
+# firebase_admin keeps one pooled keep-alive session per app, so a short
+# timeout lets a dead connection be dropped and re-dialled instead of
+# stalling the loop for the library default of 120 seconds.
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
 
 """Value model:
 - small gradual changes each second
 - realistic physiological ranges
 """
 
-# Device ID and database path (can be overridden by DEVICE_ID env var)
-DEVICE_ID = os.environ.get("DEVICE_ID", "QW1234")
-base_path = f"devices/{DEVICE_ID}/readings"
+# Device IDs and database paths (can be overridden by the DEVICE_ID env var,
+# which may list several comma-separated IDs to simulate a fleet; all of
+# them are written together in one multi-path update per flush; duplicate
+# IDs are dropped so each device has exactly one state row)
+DEVICE_IDS = tuple(dict.fromkeys(
+    d.strip() for d in os.environ.get("DEVICE_ID", "QW1234").split(",") if d.strip()
+))
+if not DEVICE_IDS:
+    raise ValueError(
+        "DEVICE_ID must name at least one device (comma-separated for several)."
+    )
+base_paths = tuple(f"devices/{device_id}/readings" for device_id in DEVICE_IDS)
+
+# Leaf paths of each device's reading, resolved once; send_fake_data builds
+# its values in the same order
+_FIELDS = (
+    "bloodPressure/systolic",
+    "bloodPressure/diastolic",
+    "heartRate",
+    "respiratoryRate",
+    "temperature",
+    "spo2",
+    "ecg",
+)
+_PATHS = tuple(tuple(f"{path}/{field}" for field in _FIELDS) for path in base_paths)
+_LAST_UPDATED_PATHS = tuple(f"{path}/lastUpdated" for path in base_paths)
+
+# When no reading changed, lastUpdated alone is refreshed at most this often
+# (seconds); can be overridden by HEARTBEAT_EVERY env var
+HEARTBEAT_EVERY = int(os.environ.get("HEARTBEAT_EVERY", "10"))
+
+# Number of ticks to buffer before flushing them in one multi-path update.
+# Successive samples for the same path coalesce, so only the newest is sent.
+FLUSH_EVERY = max(1, int(os.environ.get("FLUSH_EVERY", "1")))
+
+# Root reference, resolved once by _ensure_firebase() and reused for every flush
+_ROOT = None
+
+# Pending writes keyed by absolute database path
+_buffer = {}
+
+# Bounded queue of pending updates, drained by the writer thread so the
+# sampling loop never waits on the network
+_q = queue.Queue(maxsize=64)
 
-_state = {
-    # initial values for a resting healthy person
-    "systolic": 118.0,
-    "diastolic": 78.0,
-    "heartRate": 74.0,
-    "respiratoryRate": 15.0,
-    "temperature": 36.8,
-    "spo2": 98.0,
-    "ecg": 74.0,  # ECG follows heart rate closely
-}
+# Last value staged for each leaf path; only leaves that differ are re-sent
+_last_sent = {}
+_ticks_since_flush = 0
 
-_last_update_t = time.monotonic()
+class Vital(IntEnum):
+    """Index of each simulated signal along the last axis of the arrays below."""
+    HR = 0
+    ECG = 1
+    RR = 2
+    SYS = 3
+    DIA = 4
+    TEMP = 5
+    SPO2 = 6
 
-def _clamp(v: float, lo: float, hi: float) -> float:
-    return max(lo, min(hi, v))
+# State and parameters are single precision: ample for these signals and
+# half the memory of float64. Values become Python floats only in the payload.
+_DTYPE = np.float32
 
-def _ou_step(name: str, lo: float, hi: float, mu: float, theta: float, sigma: float, dt: float) -> float:
-    """Ornstein-Uhlenbeck step: drift towards mean + gaussian noise.
+# Current values, one row per device, initialised for a resting healthy
+# person (ECG follows heart rate closely)
+_x = np.tile(np.array([74.0, 74.0, 15.0, 118.0, 78.0, 36.8, 98.0], dtype=_DTYPE),
+             (len(DEVICE_IDS), 1))
 
-    x += theta * (mu - x) * dt + sigma * sqrt(dt) * N(0,1)
+# Per-signal OU parameters:
+# - heart rate: moderate variation around 75
+# - ECG: faster, follows heart rate with slightly larger noise
+# - respiratory rate: slower, loosely correlated with heart rate
+# - blood pressure: slower and more stable
+# - temperature: very slow changes, narrow range
+# - SpO2: nearly constant
+# Means are per device because the ECG and respiratory rate means are
+# recomputed from each device's heart rate every tick.
+_mu = np.tile(np.array([75.0, 74.0, 14.0, 118.0, 78.0, 36.8, 98.5], dtype=_DTYPE),
+              (len(DEVICE_IDS), 1))
+_theta = np.array([0.6, 1.8, 0.35, 0.18, 0.18, 0.06, 0.25], dtype=_DTYPE)
+_sigma = np.array([1.5, 3.0, 0.25, 0.7, 0.5, 0.03, 0.12], dtype=_DTYPE)
+_lo = np.array([60.0, 55.0, 12.0, 105.0, 65.0, 36.5, 96.0], dtype=_DTYPE)
+_hi = np.array([100.0, 110.0, 20.0, 130.0, 85.0, 37.2, 100.0], dtype=_DTYPE)
+
+# Standard normals are drawn in large batches and handed out in slices
+_rng = np.random.default_rng()
+_NOISE_BATCH = max(4096, 16 * _x.size)
+_noise_buf = _rng.standard_normal(_NOISE_BATCH, dtype=_DTYPE)
+_noise_idx = 0
+
+_last_update_ns = time.time_ns()
+
+def _noise(n: int) -> np.ndarray:
+    """Return the next n standard normals from the pre-drawn buffer."""
+    global _noise_idx
+    if _noise_idx + n > _NOISE_BATCH:
+        _rng.standard_normal(dtype=_DTYPE, out=_noise_buf)
+        _noise_idx = 0
+    s = _noise_buf[_noise_idx:_noise_idx + n]
+    _noise_idx += n
+    return s
+
+def _ou_kernel_loop(x, mu, theta, sigma, lo, hi, dt, noise):
+    """Advance each x[d, i] by one clamped OU step, in place.
+
+    Loops signal-major so each signal's parameters are loaded into locals
+    once and shared by every device. Only used compiled by numba.
+    """
+    for i in range(x.shape[1]):
+        th = theta[i]
+        x_lo = lo[i]
+        x_hi = hi[i]
+        keep = math.exp(-th * dt)
+        spread = sigma[i] * math.sqrt((1.0 - keep * keep) / (2.0 * th))
+        for d in range(x.shape[0]):
+            m = mu[d, i]
+            v = m + (x[d, i] - m) * keep + spread * noise[d, i]
+            x[d, i] = min(x_hi, max(x_lo, v))
+
+def _ou_kernel_numpy(x, mu, theta, sigma, lo, hi, dt, noise):
+    """Vectorized NumPy equivalent of _ou_kernel_loop, used without numba."""
+    keep = np.exp(-theta * dt)
+    spread = sigma * np.sqrt((1.0 - keep * keep) / (2.0 * theta))
+    np.clip(mu + (x - mu) * keep + spread * noise, lo, hi, out=x)
+
+if njit is not None:
+    # Only when numba is installed (it is optional, not in requirements.txt):
+    # compiled eagerly for a fixed signature, so the machine code is built
+    # (or loaded from the on-disk cache) at import, not on the first tick
+    _ou_kernel = njit(
+        "void(f4[:, :], f4[:, :], f4[:], f4[:], f4[:], f4[:], f4, f4[:, :])",
+        cache=True, fastmath=True,
+    )(_ou_kernel_loop)
+else:
+    _ou_kernel = _ou_kernel_numpy
+
+def _ou_step(dt: float) -> None:
+    """Ornstein-Uhlenbeck step for every signal of every device, updating _x in place.
+
+    Samples the exact OU transition over dt, which stays stable for any
+    step size (an Euler step oscillates once theta * dt > 1):
+    x = mu + (x - mu) * e^(-theta*dt)
+          + sigma * sqrt((1 - e^(-2*theta*dt)) / (2*theta)) * N(0,1)
     - theta: rate of mean reversion
     - sigma: noise magnitude
     - dt: time delta in seconds
     """
-    x = float(_state[name])
+    _mu[:, Vital.ECG] = _x[:, Vital.HR]
+    _mu[:, Vital.RR] = np.clip(14.0 + (_x[:, Vital.HR] - 75.0) * 0.05, 12.0, 18.0)
     # gaussian noise (mean 0)
-    noise = random.gauss(0.0, 1.0)
-    x += theta * (mu - x) * dt + sigma * (dt ** 0.5) * noise
-    x = _clamp(x, lo, hi)
-    _state[name] = x
-    return x
+    noise = _noise(_x.size).reshape(_x.shape)
+    _ou_kernel(_x, _mu, _theta, _sigma, _lo, _hi, dt, noise)
 
-def send_fake_data():
-    global _last_update_t
-    now = time.monotonic()
-    dt = max(0.1, now - _last_update_t)  # protect against dt=0
+def _writer():
+    """Background worker: push queued multi-path updates to the database."""
+    while True:
+        updates = _q.get()
+        try:
+            _ROOT.update(updates)
+            devices = len({path.split("/", 2)[1] for path in updates})
+            print(f"Sent {len(updates)} path(s) for {devices} device(s)")
+        except Exception as e:
+            # log error and continue; forget what was sent so the next tick
+            # writes every field again instead of only the ones that changed
+            print(f"Failed to send data: {e}")
+            _last_sent.clear()
+        finally:
+            _q.task_done()
 
-    # heart rate: moderate variation around 75
-    heart_rate = _ou_step(
-        "heartRate", lo=60, hi=100, mu=75.0, theta=0.6, sigma=1.5, dt=dt
-    )
+def _ensure_firebase():
+    """Initialise Firebase and start the writer thread, once, on first use.
 
-    # ECG: faster, follows heart rate with slightly larger noise
-    ecg_val = _ou_step(
-        "ecg", lo=55, hi=110, mu=float(heart_rate), theta=1.8, sigma=3.0, dt=dt
-    )
+    Kept out of module import so the simulation can be imported (and
+    --validate run) without loading firebase_admin or the credentials.
+    """
+    global _ROOT
+    if _ROOT is not None:
+        return
 
-    # respiratory rate: slower, loosely correlated with heart rate
-    rr_mu = _clamp(14.0 + (float(heart_rate) - 75.0) * 0.05, 12.0, 18.0)
-    respiratory_rate = _ou_step(
-        "respiratoryRate", lo=12, hi=20, mu=rr_mu, theta=0.35, sigma=0.25, dt=dt
-    )
+    import firebase_admin
+    from firebase_admin import credentials, db
 
-    # blood pressure: slower and more stable
-    systolic = _ou_step(
-        "systolic", lo=105, hi=130, mu=118.0, theta=0.18, sigma=0.7, dt=dt
-    )
-    diastolic = _ou_step(
-        "diastolic", lo=65, hi=85, mu=78.0, theta=0.18, sigma=0.5, dt=dt
-    )
+    if not CRED_PATH.exists():
+        raise FileNotFoundError(
+            f"Firebase credentials file not found: {CRED_PATH}\n"
+            "Tip: Put your service account JSON next to this script or set FIREBASE_CREDENTIALS to its absolute path."
+        )
+
+    # Load service account credentials
+    cred = credentials.Certificate(str(CRED_PATH))
+
+    # Initialize Firebase app
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': 'https://spider-doctor-default-rtdb.firebaseio.com/',
+            'httpTimeout': HTTP_TIMEOUT,
+        })
+
+    _ROOT = db.reference("/")
+    threading.Thread(target=_writer, name="firebase-writer", daemon=True).start()
+
+def _flush():
+    """Hand all buffered writes to the writer thread as one update."""
+    global _ticks_since_flush
+    _ticks_since_flush = 0
+    if not _buffer:
+        return
+    _ensure_firebase()
+    updates = dict(_buffer)
+    _buffer.clear()
+    try:
+        _q.put_nowait(updates)
+    except queue.Full:
+        # writer is behind: coalesce everything pending into a single
+        # update (newest values win) instead of dropping changed fields
+        merged = {}
+        while True:
+            try:
+                merged.update(_q.get_nowait())
+            except queue.Empty:
+                break
+            _q.task_done()
+        merged.update(updates)
+        _q.put_nowait(merged)
+
+def _drain():
+    """Flush the buffer and block until the writer has sent everything."""
+    _flush()
+    _q.join()
+
+def send_fake_data():
+    global _last_update_ns, _ticks_since_flush
+    # one clock read serves both the step size and the Unix timestamp
+    now_ns = time.time_ns()
+    dt = max(0.1, (now_ns - _last_update_ns) * 1e-9)  # protect against dt<=0
+
+    _ou_step(dt)
     # ensure diastolic is reasonably lower than systolic
-    if diastolic > systolic - 25:
-        diastolic = systolic - 25
-        diastolic = _clamp(diastolic, 60, 90)
-        _state["diastolic"] = diastolic
-
-    # temperature: very slow changes, narrow range
-    temperature = _ou_step(
-        "temperature", lo=36.5, hi=37.2, mu=36.8, theta=0.06, sigma=0.03, dt=dt
-    )
+    dia_cap = _x[:, Vital.SYS] - 25
+    too_high = _x[:, Vital.DIA] > dia_cap
+    _x[too_high, Vital.DIA] = np.clip(dia_cap[too_high], 60, 90)
+
+    _last_update_ns = now_ns
 
-    # SpO2: nearly constant
-    spo2 = _ou_step("spo2", lo=96, hi=100, mu=98.5, theta=0.25, sigma=0.12, dt=dt)
+    timestamp = now_ns // 1_000_000_000  # وقت Unix
 
-    _last_update_t = now
+    # round every signal in one call; tolist() yields plain ints for JSON
+    ints = np.rint(_x).astype(np.int64).tolist()
+    temps = _x[:, Vital.TEMP].tolist()
 
-    timestamp = int(time.time())  # وقت Unix
+    updates = {}
+    for row, temperature, paths, last_updated_path in zip(
+        ints, temps, _PATHS, _LAST_UPDATED_PATHS
+    ):
+        values = (
+            row[Vital.SYS],
+            row[Vital.DIA],
+            row[Vital.HR],
+            row[Vital.RR],
+            round(temperature, 1),
+            row[Vital.SPO2],
+            row[Vital.ECG],
+        )
 
-    data = {
-        "bloodPressure": {
-            "systolic": int(round(systolic)),
-            "diastolic": int(round(diastolic)),
-        },
-        "heartRate": int(round(heart_rate)),
-        "respiratoryRate": int(round(respiratory_rate)),
-        "temperature": round(float(temperature), 1),
-        "spo2": int(round(spo2)),
-        "ecg": int(round(ecg_val)),
-        "lastUpdated": timestamp,
-    }
+        # stage only the leaves whose rounded value changed since the last send
+        changed = {
+            path: value
+            for path, value in zip(paths, values)
+            if _last_sent.get(path) != value
+        }
+        # skip the device entirely while nothing changed, apart from a periodic
+        # heartbeat so consumers can still tell the device is alive
+        if changed or timestamp - _last_sent.get(last_updated_path, 0) >= HEARTBEAT_EVERY:
+            changed[last_updated_path] = timestamp
+        updates.update(changed)
 
-    try:
-        ref = db.reference(base_path)
-        ref.set(data)
-        print(f"Data sent at {timestamp}: {data}")
-    except Exception as e:
-        # log error and continue
-        print(f"Failed to send data: {e}")
+    _last_sent.update(updates)
+    _buffer.update(updates)
+    _ticks_since_flush += 1
+    if _ticks_since_flush >= FLUSH_EVERY:
+        _flush()
 
 def main():
     import argparse
@@ -155,18 +332,31 @@ def main():
         print(f"Credential file: {CRED_PATH} -> exists: {CRED_PATH.exists()}")
         return
 
+    # fail fast on missing credentials before the first sample is taken
+    _ensure_firebase()
+
     if args.once:
         send_fake_data()
+        _drain()
         return
 
-    # continuous run: send one sample per second
+    # continuous run: send one sample per second on a fixed cadence,
+    # sleeping only for what is left of the current tick
     try:
+        next_tick = time.monotonic()
         while True:
             send_fake_data()
-            # 1 second pause to allow natural variation
-            time.sleep(1)
+            next_tick += 1.0
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1.0:
+                # fell a whole tick behind (e.g. host suspended): resync
+                # rather than bursting to catch up
+                next_tick = time.monotonic()
     except KeyboardInterrupt:
         print('\nInterrupted; exiting')
+        _drain()
 
 if __name__ == "__main__":
     main()